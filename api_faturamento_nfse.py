@@ -6,14 +6,22 @@ Valores retornados em CENTAVOS (inteiro)
 
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field, validator
 from typing import Optional, Dict
-import requests
+import httpx
+import asyncio
 import base64
-import tempfile
+import hashlib
 import os
 import re
-from bs4 import BeautifulSoup
+import ssl
+from array import array
+from collections import OrderedDict
+import lxml.html
+import numpy as np
+from lxml import etree
+from cachetools import TTLCache
 from cryptography.hazmat.primitives.serialization import pkcs12
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
@@ -25,7 +33,8 @@ from cryptography.hazmat.primitives import serialization
 app = FastAPI(
     title="API Faturamento NFS-e",
     description="Consulta de faturamento com detalhamento mensal (valores em centavos)",
-    version="2.0.0"
+    version="2.0.0",
+    default_response_class=ORJSONResponse
 )
 
 app.add_middleware(
@@ -74,7 +83,8 @@ class ConsultaRequest(BaseModel):
 
 
 class ConsultaResponse(BaseModel):
-    """Modelo de resposta"""
+    """Modelo de resposta (apenas documentação; a rota serializa direto
+    via orjson, sem round-trip de validação Pydantic)"""
     cnpj: str
     razao_social: str
     ano: int
@@ -86,247 +96,496 @@ class ConsultaResponse(BaseModel):
 
 
 # ============================================
-# FUNÇÕES AUXILIARES
+# AUTENTICAÇÃO
 # ============================================
 
-def reais_para_centavos(valor_reais: float) -> int:
-    """Converte valor em reais para centavos (inteiro)
-    Exemplo: 45780.01 → 4578001
+_DIGITS_RE = re.compile(r'[^\d]')
+# O token antiforgery é um único input na página de login; um regex sobre os
+# bytes crus dispensa montar uma árvore HTML só para lê-lo
+_TOKEN_RE = re.compile(rb'name="__RequestVerificationToken"[^>]*value="([^"]+)"')
+
+def criar_client(ssl_context: Optional[ssl.SSLContext] = None) -> httpx.AsyncClient:
+    """Cria cliente HTTP assíncrono com pool de conexões keep-alive e HTTP/2"""
+    transport = httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=2,
+        verify=ssl_context if ssl_context is not None else True,
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64)
+    )
+    return httpx.AsyncClient(
+        transport=transport,
+        timeout=30,
+        follow_redirects=True,
+        headers={
+            'User-Agent': 'Mozilla/5.0',
+            # Brotli primeiro: HTML verboso encolhe ~20% a mais que gzip
+            'Accept-Encoding': 'br, gzip, deflate'
+        }
+    )
+
+
+# Cache LRU de certificados já decodificados: o load do PKCS12 é caro
+# (derivação de chave) e o mesmo tenant repete o mesmo certificado a cada
+# chamada. Chaveado por hash do base64 + hash da senha (nunca o conteúdo cru)
+_PKCS12_CACHE: OrderedDict = OrderedDict()
+_PKCS12_CACHE_MAX = 64
+
+
+def _criar_ssl_context(cert_pem: bytes, key_pem: bytes) -> ssl.SSLContext:
+    """Monta um SSLContext com o par cert/chave direto da memória
+
+    Os PEMs são expostos via memfd (arquivo anônimo em RAM) apenas pelo
+    tempo do load_cert_chain, então a chave privada nunca toca o disco.
     """
-    return int(round(valor_reais * 100))
+    ctx = ssl.create_default_context()
+    cert_fd = os.memfd_create('nfse-cert')
+    key_fd = os.memfd_create('nfse-key')
+    try:
+        os.write(cert_fd, cert_pem)
+        os.write(key_fd, key_pem)
+        ctx.load_cert_chain(f"/proc/self/fd/{cert_fd}", f"/proc/self/fd/{key_fd}")
+    finally:
+        os.close(cert_fd)
+        os.close(key_fd)
+    return ctx
 
 
-# ============================================
-# AUTENTICAÇÃO
-# ============================================
+def carregar_pkcs12(cert_base64: str, senha: str) -> ssl.SSLContext:
+    """Decodifica o PKCS12 e devolve o SSLContext pronto, com cache LRU
+
+    Entradas repetidas reutilizam o contexto já montado, pulando tanto a
+    derivação de chave do PKCS12 quanto a serialização PEM.
+    """
+    chave = (
+        hashlib.sha256(cert_base64.encode()).hexdigest(),
+        hashlib.sha256(senha.encode()).hexdigest()
+    )
+
+    cached = _PKCS12_CACHE.get(chave)
+    if cached is not None:
+        _PKCS12_CACHE.move_to_end(chave)
+        return cached
+
+    cert_data = base64.b64decode(cert_base64)
+    private_key, certificate, ca_certs = pkcs12.load_key_and_certificates(
+        cert_data, senha.encode(), backend=default_backend()
+    )
+
+    cert_pem = certificate.public_bytes(serialization.Encoding.PEM)
+    key_pem = private_key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption()
+    )
+    ctx = _criar_ssl_context(cert_pem, key_pem)
+
+    _PKCS12_CACHE[chave] = ctx
+    while len(_PKCS12_CACHE) > _PKCS12_CACHE_MAX:
+        _PKCS12_CACHE.popitem(last=False)
+
+    return ctx
 
-def autenticar_certificado(cert_base64: str, senha: str) -> requests.Session:
+
+async def autenticar_certificado(cert_base64: str, senha: str) -> httpx.AsyncClient:
     """Autenticação via certificado digital"""
     try:
-        cert_data = base64.b64decode(cert_base64)
-        private_key, certificate, ca_certs = pkcs12.load_key_and_certificates(
-            cert_data, senha.encode(), backend=default_backend()
-        )
+        # Em thread: num cache miss a derivação de chave do PKCS12 é cara
+        # e bloquearia o event loop para todas as requisições concorrentes
+        ssl_context = await asyncio.to_thread(carregar_pkcs12, cert_base64, senha)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Erro ao carregar certificado: {str(e)}")
-    
-    temp_dir = tempfile.mkdtemp()
-    cert_path = os.path.join(temp_dir, 'cert.pem')
-    key_path = os.path.join(temp_dir, 'key.pem')
-    
-    with open(cert_path, 'wb') as f:
-        f.write(certificate.public_bytes(serialization.Encoding.PEM))
-    with open(key_path, 'wb') as f:
-        f.write(private_key.private_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PrivateFormat.PKCS8,
-            encryption_algorithm=serialization.NoEncryption()
-        ))
-    
-    session = requests.Session()
-    session.headers.update({'User-Agent': 'Mozilla/5.0'})
-    session.cert = (cert_path, key_path)
-    session.temp_cert_path = cert_path
-    session.temp_key_path = key_path
-    session.temp_dir = temp_dir
-    
+
+    client = criar_client(ssl_context=ssl_context)
+
     try:
-        resp = session.get("https://www.nfse.gov.br/EmissorNacional/Certificado", timeout=30)
-        if 'Emissor' not in session.cookies:
+        resp = await client.get("https://www.nfse.gov.br/EmissorNacional/Certificado")
+        if 'Emissor' not in client.cookies:
             raise HTTPException(status_code=401, detail="Falha na autenticação")
-        return session
+        return client
     except Exception as e:
-        limpar_temp(session)
+        await client.aclose()
         raise HTTPException(status_code=401, detail=str(e))
 
 
-def autenticar_login(cnpj: str, senha: str) -> requests.Session:
+def _chave_credencial(req: ConsultaRequest) -> tuple:
+    """Fingerprint da credencial para chaves de cache (sempre hashes,
+    nunca o material cru)"""
+    if req.auth_method == 1:
+        return ('cert', hashlib.sha256(req.cert_base64.encode()).hexdigest(),
+                hashlib.sha256(req.cert_senha.encode()).hexdigest())
+    return ('login', _DIGITS_RE.sub('', req.cnpj),
+            hashlib.sha256(req.senha.encode()).hexdigest())
+
+
+# Cookies de sessão recentes por credencial: enquanto o cookie 'Emissor'
+# vale, dá para pular o fluxo completo de autenticação (token + POST de
+# login ou handshake de certificado)
+_COOKIE_CACHE: TTLCache = TTLCache(maxsize=256, ttl=600)
+
+
+async def autenticar(req: ConsultaRequest) -> httpx.AsyncClient:
+    """Autentica reaproveitando a sessão recente da mesma credencial
+
+    Com cookies em cache, um GET barato confirma que a sessão ainda vale
+    (sem cookie válido o portal redireciona para o login); se expirou, a
+    entrada é invalidada e o fluxo completo roda de novo.
+    """
+    chave = _chave_credencial(req)
+
+    cookies = _COOKIE_CACHE.get(chave)
+    if cookies is not None:
+        ssl_context = None
+        if req.auth_method == 1:
+            try:
+                ssl_context = await asyncio.to_thread(
+                    carregar_pkcs12, req.cert_base64, req.cert_senha
+                )
+            except Exception:
+                ssl_context = None
+        if req.auth_method != 1 or ssl_context is not None:
+            client = criar_client(ssl_context=ssl_context)
+            client.cookies.update(cookies)
+            try:
+                # Sem seguir redirect de propósito: sessão expirada vira
+                # 302 para o login, que é o sinal de invalidação
+                resp = await client.get(
+                    "https://www.nfse.gov.br/EmissorNacional/Notas/Emitidas",
+                    follow_redirects=False
+                )
+                if resp.status_code == 200:
+                    return client
+            except Exception:
+                pass
+            _COOKIE_CACHE.pop(chave, None)
+            await client.aclose()
+
+    if req.auth_method == 1:
+        client = await autenticar_certificado(req.cert_base64, req.cert_senha)
+    else:
+        client = await autenticar_login(req.cnpj, req.senha)
+
+    _COOKIE_CACHE[chave] = dict(client.cookies)
+    return client
+
+
+async def autenticar_login(cnpj: str, senha: str) -> httpx.AsyncClient:
     """Autenticação via login/senha"""
-    session = requests.Session()
-    session.headers.update({'User-Agent': 'Mozilla/5.0'})
-    
+    client = criar_client()
+
     try:
         base_url = "https://www.nfse.gov.br"
-        resp = session.get(f"{base_url}/EmissorNacional", timeout=30)
-        
-        soup = BeautifulSoup(resp.text, 'html.parser')
-        token_input = soup.find('input', {'name': '__RequestVerificationToken'})
-        token = token_input.get('value', '') if token_input else ''
-        
-        cnpj_limpo = re.sub(r'[^\d]', '', cnpj)
-        
-        resp = session.post(
+        resp = await client.get(f"{base_url}/EmissorNacional")
+
+        match = _TOKEN_RE.search(resp.content)
+        token = match.group(1).decode() if match else ''
+
+        cnpj_limpo = _DIGITS_RE.sub('', cnpj)
+
+        resp = await client.post(
             f"{base_url}/EmissorNacional/Login?ReturnUrl=%2FEmissorNacional",
             data={'__RequestVerificationToken': token, 'Inscricao': cnpj_limpo, 'Senha': senha},
-            allow_redirects=True,
-            timeout=30
+            follow_redirects=True
         )
-        
-        if 'Emissor' not in session.cookies:
+
+        if 'Emissor' not in client.cookies:
             raise HTTPException(status_code=401, detail="Credenciais inválidas")
-        
-        return session
+
+        return client
     except HTTPException:
+        await client.aclose()
         raise
     except Exception as e:
+        await client.aclose()
         raise HTTPException(status_code=401, detail=str(e))
 
 
-def limpar_temp(session):
-    """Limpa arquivos temporários"""
-    try:
-        if hasattr(session, 'temp_cert_path'): os.remove(session.temp_cert_path)
-        if hasattr(session, 'temp_key_path'): os.remove(session.temp_key_path)
-        if hasattr(session, 'temp_dir'): os.rmdir(session.temp_dir)
-    except: pass
-
-
 # ============================================
 # SCRAPING
 # ============================================
 
-def processar_pagina(html: str, ano: int, mes_filtro: Optional[int]):
-    """Processa uma página HTML e extrai notas"""
-    notas = []
+# XPaths compilados uma única vez (avaliação em C, sem re-parse por página)
+ROW_XPATH = etree.XPath("//tbody/tr[td[@class='td-competencia']]")
+# Um único passe C por linha devolve competência e valor já concatenados,
+# em vez de duas chamadas XPath separadas por célula
+CELLS_XPATH = etree.XPath(
+    "concat(td[@class='td-competencia'], '|', td[@class='td-valor'])"
+)
+PAG_HREF_XPATH = etree.XPath("//div[@class='paginacao']//a/@href")
+_ANC_PAG_XPATH = etree.XPath("boolean(ancestor::div[@class='paginacao'])")
+PERFIL_XPATH = etree.XPath(
+    "//li[contains(@class,'dropdown') and contains(@class,'perfil')]"
+    "//li[contains(@class,'dropdown-header')]"
+)
+CNPJ_XPATH = etree.XPath("string(.//span[@class='cnpj'])")
+_ANC_PERFIL_XPATH = etree.XPath("boolean(ancestor::li[contains(@class,'perfil')])")
+
+_COMP_RE = re.compile(r'(\d{2})/(\d{4})')
+_PG_RE = re.compile(r'pg=(\d+)')
+
+# "1.234.567,89" -> "123456789" (centavos): o valor vira int direto, sem
+# parse de ponto flutuante nem erro de arredondamento acumulado
+_BRL_CENTAVOS_TABLE = str.maketrans('', '', '.,')
+
+
+def processar_linha(linha, ano: int, mes_filtro: Optional[int]):
+    """Processa um <tr> de nota; retorna ((mes, valor) ou None, continuar)
+
+    O ano e o status são implícitos: só entram notas autorizadas do ano
+    consultado, então guardar os dois por nota seria redundante.
+    """
+    comp_txt, _, valor_txt = CELLS_XPATH(linha).partition('|')
+
+    match = _COMP_RE.search(comp_txt.strip())
+    if not match: return None, True
+
+    mes_nota = int(match.group(1))
+    ano_nota = int(match.group(2))
+
+    # Se ano diferente, para
+    if ano_nota != ano:
+        return None, False
+
+    # Se tem filtro de mês
+    if mes_filtro is not None:
+        # Se passou do mês filtrado (notas mais antigas), para
+        if mes_nota < mes_filtro:
+            return None, False
+        # Se não é o mês filtrado, ignora
+        if mes_nota != mes_filtro:
+            return None, True
+
+    # Extrai status
+    status_cod = linha.get('data-situacao')
+    if not status_cod or 'GERADA' not in status_cod:  # Só considera autorizadas
+        return None, True
+
+    # Extrai valor (em centavos, inteiro exato)
+    valor_txt = valor_txt.strip()
+    if not valor_txt: return None, True
+
+    valor = int(valor_txt.translate(_BRL_CENTAVOS_TABLE))
+
+    return (mes_nota, valor), True
+
+
+def processar_pagina(doc, ano: int, mes_filtro: Optional[int]):
+    """Processa uma página já parseada (lxml) e extrai notas
+
+    Acumula em SoA (array de meses + array de valores) em vez de um dict
+    por nota: arrays contíguos custam ~1 byte + 8 bytes por nota e entram
+    direto no bincount da totalização. A última página conhecida sai da
+    mesma árvore, então o chamador não precisa tocá-la de novo.
+    Retorna (meses, valores, continuar, max_pagina).
+    """
+    meses = array('B')
+    valores = array('q')
     continuar = True
-    
-    soup = BeautifulSoup(html, 'html.parser')
-    tbody = soup.find('tbody')
-    if not tbody: return notas, False
-    
-    for linha in tbody.find_all('tr'):
+
+    linhas = ROW_XPATH(doc)
+    if not linhas: return meses, valores, False, 1
+
+    for linha in linhas:
         try:
-            td_comp = linha.find('td', class_='td-competencia')
-            if not td_comp: continue
-            
-            match = re.search(r'(\d{2})/(\d{4})', td_comp.get_text(strip=True))
-            if not match: continue
-            
-            mes_nota = int(match.group(1))
-            ano_nota = int(match.group(2))
-            
-            # Se ano diferente, para
-            if ano_nota != ano:
-                continuar = False
-                break
-            
-            # Se tem filtro de mês
-            if mes_filtro is not None:
-                # Se passou do mês filtrado (notas mais antigas), para
-                if mes_nota < mes_filtro:
-                    continuar = False
-                    break
-                # Se não é o mês filtrado, ignora
-                if mes_nota != mes_filtro:
-                    continue
-            
-            # Extrai status
-            status_cod = linha.get('data-situacao', '')
-            if 'GERADA' not in status_cod:  # Só considera autorizadas
-                continue
-            
-            # Extrai valor
-            td_valor = linha.find('td', class_='td-valor')
-            if not td_valor: continue
-            
-            valor_txt = td_valor.get_text(strip=True)
-            valor = float(valor_txt.replace('.', '').replace(',', '.'))
-            
-            notas.append({
-                'mes': mes_nota,
-                'ano': ano_nota,
-                'valor': valor,
-                'status': 'Autorizada'
-            })
-            
+            nota, continuar = processar_linha(linha, ano, mes_filtro)
+            if nota:
+                meses.append(nota[0])
+                valores.append(nota[1])
+            if not continuar: break
         except: continue
-    
-    return notas, continuar
 
+    return meses, valores, continuar, extrair_max_pagina(doc)
 
-def consultar_notas(session: requests.Session, ano: int, mes_filtro: Optional[int]):
-    """Consulta todas as notas do período"""
-    todas_notas = []
-    pagina = 1
-    base_url = "https://www.nfse.gov.br/EmissorNacional/Notas/Emitidas"
-    
-    while True:
-        url = base_url if pagina == 1 else f"{base_url}?pg={pagina}"
-        
-        try:
-            resp = session.get(url, timeout=30)
-            if resp.status_code != 200: break
-            
-            notas, continuar = processar_pagina(resp.text, ano, mes_filtro)
-            todas_notas.extend(notas)
-            
+
+async def processar_pagina_stream(client: httpx.AsyncClient, url: str,
+                                  ano: int, mes_filtro: Optional[int]):
+    """Processa uma página em streaming com parser incremental
+
+    Alimenta um HTMLPullParser chunk a chunk e para de ler o socket assim
+    que a linha-limite (ano/mês anterior) aparece, economizando download e
+    parse do resto da página. O bloco de perfil aparece antes da tabela,
+    então o contribuinte também é capturado de passagem, e os links da
+    paginação revelam a última página conhecida (o href de "Próxima"
+    conta, então janelas deslizantes de paginação também funcionam).
+    Retorna (meses, valores, continuar, max_pagina, contribuinte).
+    """
+    parser = etree.HTMLPullParser(events=('end',), tag=('tr', 'a', 'li'))
+    meses = array('B')
+    valores = array('q')
+    continuar = True
+    max_pagina = 1
+    contribuinte = None
+
+    async with client.stream('GET', url) as resp:
+        if resp.status_code != 200:
+            return meses, valores, False, 1, None
+
+        async for chunk in resp.aiter_bytes():
+            parser.feed(chunk)
+            for _, elem in parser.read_events():
+                if elem.tag == 'a':
+                    if _ANC_PAG_XPATH(elem):
+                        m = _PG_RE.search(elem.get('href') or '')
+                        if m: max_pagina = max(max_pagina, int(m.group(1)))
+                elif elem.tag == 'li':
+                    if (contribuinte is None
+                            and 'dropdown-header' in (elem.get('class') or '')
+                            and _ANC_PERFIL_XPATH(elem)):
+                        try:
+                            contribuinte = _contribuinte_do_header(elem)
+                        except: pass
+                else:
+                    try:
+                        nota, continuar = processar_linha(elem, ano, mes_filtro)
+                        if nota:
+                            meses.append(nota[0])
+                            valores.append(nota[1])
+                    except: pass
+                elem.clear()
+                if not continuar: break
             if not continuar: break
-            
-            # Verifica se tem próxima página
-            soup = BeautifulSoup(resp.text, 'html.parser')
-            pag_div = soup.find('div', class_='paginacao')
-            if not pag_div or not pag_div.find('a', title='Próxima'): break
-            
+
+    return meses, valores, continuar, max_pagina, contribuinte
+
+
+def extrair_max_pagina(doc) -> int:
+    """Extrai o maior número de página dos links da paginação"""
+    paginas = [int(m.group(1)) for href in PAG_HREF_XPATH(doc)
+               if (m := _PG_RE.search(href))]
+    return max(paginas) if paginas else 1
+
+
+async def consultar_notas(client: httpx.AsyncClient, ano: int, mes_filtro: Optional[int]):
+    """Consulta todas as notas do período
+
+    A página 1 é a mesma URL usada para identificar o contribuinte, então
+    os dados do perfil são extraídos dela de carona, sem GET adicional.
+    A totalização acontece aqui mesmo, num único passe sobre os arrays,
+    para o endpoint não reiterar as notas.
+    Retorna (quantidade, detalhamento_por_mes, (cnpj, razao_social)).
+    """
+    base_url = "https://www.nfse.gov.br/EmissorNacional/Notas/Emitidas"
+
+    if mes_filtro is not None:
+        # Com filtro de mês a ordem importa (early-break no limite do mês),
+        # então as páginas são percorridas em série e em streaming: o
+        # download é interrompido assim que a linha-limite aparece
+        todos_meses = array('B')
+        todos_valores = array('q')
+        contribuinte = None
+        pagina = 1
+        max_conhecida = 1
+        while True:
+            url = base_url if pagina == 1 else f"{base_url}?pg={pagina}"
+            try:
+                meses, valores, continuar, max_pagina, perfil = await processar_pagina_stream(
+                    client, url, ano, mes_filtro
+                )
+            except Exception as e:
+                raise HTTPException(status_code=500, detail=f"Erro ao consultar página {pagina}: {str(e)}")
+
+            if contribuinte is None: contribuinte = perfil
+            todos_meses.extend(meses)
+            todos_valores.extend(valores)
+            # A última página conhecida vem dos links de paginação; páginas
+            # seguintes podem revelar números maiores (janela deslizante)
+            max_conhecida = max(max_conhecida, max_pagina)
+            if not continuar or pagina >= max_conhecida: break
             pagina += 1
-            
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Erro ao consultar página {pagina}: {str(e)}")
-    
-    return todas_notas
 
+        return (len(todos_valores),
+                totalizar_por_mes(todos_meses, todos_valores, ano, mes_filtro),
+                contribuinte or ('N/A', 'N/A'))
 
-def extrair_contribuinte(session: requests.Session):
-    """Extrai dados do contribuinte"""
     try:
-        resp = session.get("https://www.nfse.gov.br/EmissorNacional/Notas/Emitidas", timeout=30)
-        soup = BeautifulSoup(resp.text, 'html.parser')
-        
-        perfil = soup.find('li', class_='dropdown perfil')
-        if perfil:
-            header = perfil.find('li', class_='dropdown-header')
-            if header:
-                texto = header.get_text()
-                linhas = texto.strip().split('\n')
-                nome = linhas[0].strip() if linhas else 'N/A'
-                
-                cnpj_span = header.find('span', class_='cnpj')
-                cnpj = cnpj_span.get_text(strip=True) if cnpj_span else 'N/A'
-                
-                return cnpj, nome
-        
+        resp = await client.get(base_url)
+        if resp.status_code != 200:
+            return 0, totalizar_por_mes(array('B'), array('q'), ano, mes_filtro), ('N/A', 'N/A')
+
+        doc = lxml.html.fromstring(resp.content)
+        contribuinte = extrair_contribuinte(doc)
+        todos_meses, todos_valores, continuar, max_pagina = processar_pagina(doc, ano, mes_filtro)
+
+        if not continuar or max_pagina <= 1:
+            return (len(todos_valores),
+                    totalizar_por_mes(todos_meses, todos_valores, ano, mes_filtro),
+                    contribuinte)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Erro ao consultar página 1: {str(e)}")
+
+    # Ano inteiro: as páginas até a última conhecida são buscadas de forma
+    # concorrente sobre o pool keep-alive (páginas de outro ano produzem
+    # listas vazias). Rodadas sucessivas cobrem janelas deslizantes de
+    # paginação: páginas novas podem revelar números maiores que a página 1
+    buscadas = 1
+    try:
+        while buscadas < max_pagina:
+            respostas = await asyncio.gather(*[
+                client.get(f"{base_url}?pg={p}")
+                for p in range(buscadas + 1, max_pagina + 1)
+            ])
+            buscadas = max_pagina
+            for resp in respostas:
+                if resp.status_code != 200: continue
+                doc = lxml.html.fromstring(resp.content)
+                meses, valores, _, max_vista = processar_pagina(doc, ano, mes_filtro)
+                todos_meses.extend(meses)
+                todos_valores.extend(valores)
+                max_pagina = max(max_pagina, max_vista)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Erro ao consultar páginas: {str(e)}")
+
+    return (len(todos_valores),
+            totalizar_por_mes(todos_meses, todos_valores, ano, mes_filtro),
+            contribuinte)
+
+
+def _contribuinte_do_header(header):
+    """Extrai (cnpj, nome) do <li class='dropdown-header'> do perfil"""
+    linhas = ''.join(header.itertext()).strip().split('\n')
+    nome = linhas[0].strip() if linhas else 'N/A'
+    cnpj = CNPJ_XPATH(header).strip() or 'N/A'
+    return cnpj, nome
+
+
+def extrair_contribuinte(doc):
+    """Extrai dados do contribuinte da página já parseada"""
+    try:
+        headers = PERFIL_XPATH(doc)
+        if headers:
+            return _contribuinte_do_header(headers[0])
         return 'N/A', 'N/A'
     except:
         return 'N/A', 'N/A'
 
 
-def totalizar_por_mes(notas: list, ano: int, mes_filtro: Optional[int]):
+def totalizar_por_mes(meses: array, valores: array, ano: int, mes_filtro: Optional[int]):
     """Totaliza valores por mês em centavos (inteiro)"""
-    # Inicializa todos os meses do ano com zero
-    meses = {}
+    # Redução vetorizada: os arrays SoA viram views NumPy sem cópia e o
+    # bincount soma os valores por mês em C (processar_pagina garante que
+    # só entram notas do ano consultado)
+    meses_idx = np.frombuffer(meses, dtype=np.uint8)
+    pesos = np.frombuffer(valores, dtype=np.int64)
+    totais = np.bincount(meses_idx, weights=pesos, minlength=13)
+
     if mes_filtro is not None:
         # Apenas o mês filtrado
-        meses[f"{mes_filtro:02d}/{ano}"] = 0.0
-    else:
-        # Ano inteiro
-        for m in range(1, 13):
-            meses[f"{m:02d}/{ano}"] = 0.0
-    
-    # Soma valores por mês
-    for nota in notas:
-        chave = f"{nota['mes']:02d}/{nota['ano']}"
-        if chave in meses:
-            meses[chave] += nota['valor']
-    
-    # Converte para centavos (inteiro)
-    meses_centavos = {k: reais_para_centavos(v) for k, v in meses.items()}
-    
-    return meses_centavos
+        return {f"{mes_filtro:02d}/{ano}": int(totais[mes_filtro])}
+
+    # Ano inteiro
+    return {f"{m:02d}/{ano}": int(totais[m]) for m in range(1, 13)}
 
 
 # ============================================
 # ENDPOINTS
 # ============================================
 
+# Cache de respostas por (credencial, ano, mes) com TTL curto: chamadas
+# repetidas idênticas nesse intervalo nem tocam o nfse.gov.br. O dict de
+# eventos faz single-flight: N requisições idênticas concorrentes esperam
+# a primeira em vez de disparar N scrapes
+_RESP_CACHE: TTLCache = TTLCache(maxsize=1024, ttl=300)
+_INFLIGHT: dict = {}
+
 @app.get("/")
 def root():
     """Informações da API"""
@@ -349,8 +608,8 @@ def health():
     return {"status": "ok"}
 
 
-@app.post("/consultar", response_model=ConsultaResponse)
-def consultar(req: ConsultaRequest):
+@app.post("/consultar", responses={200: {"model": ConsultaResponse}})
+async def consultar(req: ConsultaRequest):
     """
     Consulta faturamento de NFS-e com detalhamento mensal
     
@@ -366,52 +625,71 @@ def consultar(req: ConsultaRequest):
     
     Retorna faturamento total e detalhamento por mês
     """
-    
-    session = None
-    
+
+    # Validação de campos obrigatórios
+    if req.auth_method == 1:
+        if not req.cert_base64:
+            raise HTTPException(status_code=400, detail="Campo obrigatório: cert_base64")
+        if not req.cert_senha:
+            raise HTTPException(status_code=400, detail="Campo obrigatório: cert_senha")
+    else:
+        if not req.cnpj:
+            raise HTTPException(status_code=400, detail="Campo obrigatório: cnpj")
+        if not req.senha:
+            raise HTTPException(status_code=400, detail="Campo obrigatório: senha")
+
+    chave = _chave_credencial(req) + (req.ano, req.mes)
+
+    while True:
+        cached = _RESP_CACHE.get(chave)
+        if cached is not None:
+            return cached
+        evento = _INFLIGHT.get(chave)
+        if evento is None:
+            evento = asyncio.Event()
+            _INFLIGHT[chave] = evento
+            break
+        # Requisição idêntica em andamento: espera o resultado e relê o cache
+        await evento.wait()
+
     try:
-        # Validação de campos obrigatórios
-        if req.auth_method == 1:
-            if not req.cert_base64:
-                raise HTTPException(status_code=400, detail="Campo obrigatório: cert_base64")
-            if not req.cert_senha:
-                raise HTTPException(status_code=400, detail="Campo obrigatório: cert_senha")
-            session = autenticar_certificado(req.cert_base64, req.cert_senha)
-        
-        elif req.auth_method == 2:
-            if not req.cnpj:
-                raise HTTPException(status_code=400, detail="Campo obrigatório: cnpj")
-            if not req.senha:
-                raise HTTPException(status_code=400, detail="Campo obrigatório: senha")
-            session = autenticar_login(req.cnpj, req.senha)
-        
-        # Extrai dados do contribuinte
-        cnpj, razao_social = extrair_contribuinte(session)
-        
-        # Consulta notas
-        notas = consultar_notas(session, req.ano, req.mes)
-        
-        # Totaliza em reais
-        total_autorizado_reais = round(sum(n['valor'] for n in notas), 2)
-        qtd_autorizadas = len(notas)
-        
-        # Converte para centavos
-        total_autorizado_centavos = reais_para_centavos(total_autorizado_reais)
-        
-        # Detalhamento por mês (já em centavos)
-        detalhamento = totalizar_por_mes(notas, req.ano, req.mes)
-        
-        # Monta resposta
-        return ConsultaResponse(
-            cnpj=cnpj,
-            razao_social=razao_social,
-            ano=req.ano,
-            mes_filtrado=req.mes,
-            quantidade_autorizadas=qtd_autorizadas,
-            total_autorizado=total_autorizado_centavos,
-            total_cancelado=0,  # Canceladas não são contabilizadas
-            detalhamento_por_mes=detalhamento
+        resposta = await _executar_consulta(req)
+        _RESP_CACHE[chave] = resposta
+        return resposta
+    finally:
+        # Em caso de erro nada é cacheado; quem espera refaz a consulta
+        _INFLIGHT.pop(chave, None)
+        evento.set()
+
+
+async def _executar_consulta(req: ConsultaRequest) -> dict:
+    """Executa autenticação + scraping + totalização de uma consulta"""
+    client = None
+
+    try:
+        client = await autenticar(req)
+
+        # Consulta notas já totalizadas (o contribuinte sai da página 1
+        # da própria consulta)
+        qtd_autorizadas, detalhamento, (cnpj, razao_social) = await consultar_notas(
+            client, req.ano, req.mes
         )
+
+        # Total geral = soma dos meses já em centavos (12 inteiros, sem
+        # segundo passe sobre as notas)
+        total_autorizado_centavos = sum(detalhamento.values())
+        
+        # Monta resposta (dict direto: ORJSONResponse serializa em C)
+        return {
+            'cnpj': cnpj,
+            'razao_social': razao_social,
+            'ano': req.ano,
+            'mes_filtrado': req.mes,
+            'quantidade_autorizadas': qtd_autorizadas,
+            'total_autorizado': total_autorizado_centavos,
+            'total_cancelado': 0,  # Canceladas não são contabilizadas
+            'detalhamento_por_mes': detalhamento
+        }
         
     except HTTPException:
         raise
@@ -419,8 +697,8 @@ def consultar(req: ConsultaRequest):
         raise HTTPException(status_code=500, detail=f"Erro inesperado: {str(e)}")
     
     finally:
-        if session:
-            limpar_temp(session)
+        if client:
+            await client.aclose()
 
 
 # ============================================
@@ -429,4 +707,13 @@ def consultar(req: ConsultaRequest):
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # uvloop + httptools reduzem o overhead por requisição do event loop e
+    # do parse HTTP; app como string para o uvicorn poder forkar workers
+    uvicorn.run(
+        "api_faturamento_nfse:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=os.cpu_count()
+    )